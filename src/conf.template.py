@@ -13,12 +13,29 @@ PORT: Final[int] = 443
 # Log path (output)
 LOG_PATH: Final[str] = "/var/log/vmware.log"
 
+# The log file is rotated to LOG_PATH.1 before a run when it exceeds this size, in MiB. 0 disables the rotation.
+MAX_LOG_SIZE_MB: Final[int] = 0
+
 INTERVAL_MINUTES: int = 15
 
+# The number of events read per page. 1000 is the max till vSphere v6.5.
+# Newer versions may accept larger values, which means fewer round-trips. If the server rejects it, 1000 is used.
+PAGE_SIZE: Final[int] = 1000
+
 # The EventFilterSpec full params details:
 # https://vdc-repo.vmware.com/vmwb-repository/dcr-public/da47f910-60ac-438b-8b9b-6122f4d14524/16b7274a-bf8b-4b4c-a05e-746f2aa93c8c/doc/vim.event.EventFilterSpec.html
 # https://helpcenter.veeam.com/docs/mp/vmware_reference/vceventsdoc.html?ver=9a
 #
+# If you want to filter by event category, define the categories: "info", "warning", "error" or "user".
+# If not defined, it would collect the events of all categories.
+EVENT_CATEGORIES: Optional[list[str]] = None
+# = ["warning", "error"]
+
+# If you want to collect the events of a single entity and its children, define its inventory path.
+# If not defined, it would collect the events of all entities.
+ENTITY_PATH: Optional[str] = None
+# = "Datacenter/host/Cluster"
+
 # If you want to filter by event type, uncomment the sample types. If not defined, it would collect all types of events.
 EVENT_TYPES: Optional[list[EventType]] = None
 # = [
@@ -49,7 +66,6 @@ EVENT_TYPES: Optional[list[EventType]] = None
 #     EventType.HostAddedEvent,
 #     EventType.HostRemovedEvent,
 #     EventType.VmCreatedEvent,
-#     EventType.VmCreatedEvent,
 #     EventType.VmRenamedEvent,
 #     EventType.VmClonedEvent,
 #     EventType.VmRemovedEvent,
@@ -1,57 +1,274 @@
 #! /usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+from __future__ import annotations
+
 import argparse
+import atexit
+import contextlib
+import errno
 import getpass
+import heapq
+import http.client
+import itertools
 import json
 import logging
 import os
+import queue
+import random
+import re
 import socket
+import ssl
 import sys
-from datetime import datetime, timedelta
-from typing import Final, Optional
-
-from pyVim.connect import SmartConnect
-from pyVmomi import vim
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from operator import attrgetter
+from typing import TYPE_CHECKING, BinaryIO, Callable, Final, Generator, Iterable, Iterator, Optional, cast
 
-from eventTypes import EventType
+if TYPE_CHECKING:
+    from pyVim.connect import Disconnect, SmartConnect, SmartStubAdapter
+    from pyVmomi import vim, vmodl
 
 USE_CONF: bool = False
 try:
+    import conf
     from conf import EVENT_TYPES, HOST, INTERVAL_MINUTES, LOG_PATH, PASSWORD, PORT, USERNAME
     USE_CONF = True
 except ImportError:
     print('No configuration file defined.')
 
+# The names of the configured event types are computed once, without the duplicates.
+EVENT_TYPE_IDS: Final[Optional[tuple[str, ...]]] = tuple(
+    sorted({e.name for e in EVENT_TYPES})) if USE_CONF and EVENT_TYPES else None
+
+USE_ORJSON: bool = False
+try:
+    import orjson
+    USE_ORJSON = True
+except ImportError:
+    pass
+
 
 ENCODING: Final[str] = "utf-8"
 APP_NAME: Final[str] = 'vmwarelog'
 APP_VERSION: Final[str] = '0.2'
 
 # The default and also the max event number per page till vSphere v6.5, you can change it to a smaller value by SetCollectorPageSize().
-PAGE_SIZE: Final[int] = 1000
+# Newer versions may accept larger pages, see PAGE_SIZE in the configuration file.
+DEFAULT_PAGE_SIZE: Final[int] = 1000
 
+# The number of pages read ahead of the writer. Keep it small to bound the memory usage.
+PREFETCH_PAGES: Final[int] = 2
 
-def get_events(event_collector: vim.event.EventHistoryCollector) -> list[vim.event.Event]:
-    events: list[vim.event.Event] = []
+# The max number of consecutive failed reads before giving up
+MAX_READ_FAILURES: Final[int] = 10
 
-    while True:
-        # If there's a huge number of events in the expected time range, this while loop will take a while.
-        events_in_page: list[vim.event.Event] = event_collector.ReadNext(
-            maxCount=PAGE_SIZE)
+# The size of the chunks written to the output file, in bytes
+WRITE_BUFFER_SIZE: Final[int] = 1 << 20
+
+# Seconds per duration unit accepted by the command line
+DURATION_UNITS: Final[dict[str, int]] = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+# The file where the session cookie is saved to be resumed in the next run
+SESSION_PATH: Final[str] = os.path.expanduser(f"~/.{APP_NAME}/session")
+
+# The interval of the keepalive calls between the runs in daemon mode, in seconds
+KEEPALIVE_SECONDS: Final[int] = 5 * 60
+
+# The max time to wait for the new events in watch mode, in seconds
+WAIT_SECONDS: Final[int] = 30
+
+# The errors of a lost connection to vCenter. The other OSErrors, like a full disk, are not recovered by reconnecting.
+# pyVmomi raises HTTPException for the unexpected responses, e.g. 503 while vCenter is restarting.
+CONNECTION_ERRORS: Final[tuple[type[Exception], ...]] = (
+    ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError, http.client.HTTPException)
+
+# An unreachable host or network, e.g. while vCenter is rebooting, is raised as a plain OSError.
+UNREACHABLE_ERRNOS: Final[frozenset[int]] = frozenset((errno.EHOSTUNREACH, errno.ENETUNREACH))
+
+# The event arguments added to the root of the log, if present
+ENTITY_ARGUMENTS: Final[tuple[str, ...]] = (
+    "host", "vm", "ds", "dvs", "net", "computeResource", "datacenter", "info", "ipAddress")
+
+# Sentinel for the missing attributes
+MISSING: Final[object] = object()
+
+# json.dumps creates a new encoder on every call when there are custom arguments, so a single one is reused.
+# It writes compact UTF-8 JSON, the same as orjson.
+JSON_ENCODER: Final[json.JSONEncoder] = json.JSONEncoder(default=str, ensure_ascii=False, separators=(",", ":"))
+
+# Sort key of the events, attrgetter avoids a Python level call per event.
+BY_CREATED_TIME: Final[Callable] = attrgetter("createdTime")
+
+# Cache of property names and getters per event type
+PROPERTY_GETTERS: dict[type, tuple[tuple[str, ...], Callable]] = {}
 
-        if len(events_in_page) == 0:
+
+def load_vmomi() -> None:
+    # Loading pyVmomi takes a considerable time, so it is deferred until the arguments are parsed.
+    # The modules are bound to the globals, so that the rest of the functions can use them as usual.
+    global Disconnect, SmartConnect, SmartStubAdapter, vim, vmodl
+    from pyVim.connect import Disconnect, SmartConnect, SmartStubAdapter
+    from pyVmomi import vim, vmodl
+
+
+def read_pages(event_collector: vim.event.EventHistoryCollector, page_size: int, pages: queue.Queue,
+               stop: threading.Event) -> None:
+    # pyVmomi may fail to parse a whole page because of a single malformed event, after the collector has moved past it.
+    # In that case, the collector is moved back over the failed page and the same range is read one by one,
+    # so that only the events that cannot be parsed are skipped. Then the pages are read as usual.
+    # Moving back may also return some of the events of the previous page, they are dropped by their keys.
+    single_reads: int = 0
+    failures: int = 0
+    # The keys of the last page_size events read, and of the events read one by one so far
+    last_keys: set[int] = set()
+    read_keys: set[int] = set()
+    try:
+        while not stop.is_set():
+            # If there's a huge number of events in the expected time range, this while loop will take a while.
+            try:
+                events_in_page: list[vim.event.Event] = event_collector.ReadNext(
+                    maxCount=1 if single_reads > 0 else page_size)
+            except (vmodl.MethodFault, OSError, http.client.HTTPException):
+                # The server faults and the connection errors are not related to a single event.
+                raise
+            except Exception as e:
+                failures += 1
+                if failures > MAX_READ_FAILURES:
+                    raise
+                if single_reads > 0:
+                    logging.warning("Skipping an event that could not be read: %s", e)
+                    single_reads -= 1
+                    if single_reads == 0:
+                        last_keys = read_keys
+                else:
+                    logging.warning(
+                        "Could not read a page of events: %s. Reading the page one by one...", e)
+                    try:
+                        event_collector.ReadPrevious(maxCount=page_size)
+                    except (vmodl.MethodFault, OSError, http.client.HTTPException):
+                        raise
+                    except Exception:
+                        # The same events cannot be parsed again, but the collector is moved back anyway.
+                        pass
+                    single_reads = page_size
+                    read_keys = set()
+                continue
+            failures = 0
+
+            if len(events_in_page) == 0:
+                break
+            if single_reads > 0:
+                single_reads -= 1
+                events_in_page = [e for e in events_in_page if e.key not in last_keys]
+                read_keys.update(e.key for e in events_in_page)
+                if single_reads == 0:
+                    last_keys = read_keys
+                if len(events_in_page) == 0:
+                    continue
+            else:
+                last_keys = {e.key for e in events_in_page}
+            pages.put(events_in_page)
+    except Exception as e:
+        # Hand the error over to the consumer, so that it is raised in the main thread.
+        pages.put(e)
+        return
+    pages.put(None)
+
+
+def iter_events(event_collector: vim.event.EventHistoryCollector,
+                page_size: int = DEFAULT_PAGE_SIZE) -> Generator[list[vim.event.Event], None, None]:
+    # The next page is read in the background while the current one is being processed.
+    # The queue is bounded, so that at most a few pages are kept in memory.
+    pages: queue.Queue = queue.Queue(maxsize=PREFETCH_PAGES)
+    stop = threading.Event()
+    # The collector is used only by the reader until the pages are consumed or closed, so it does not need a lock.
+    reader = threading.Thread(target=read_pages, name=f"{APP_NAME}-reader", args=(
+        event_collector, page_size, pages, stop), daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            events_in_page = pages.get()
+
+            if events_in_page is None:
+                break
+            if isinstance(events_in_page, Exception):
+                raise events_in_page
+
+            # Please note that the events collected are not ordered by the event creation time
+            # You might find the first event in the third page for example.
+            # The events are sorted per page and streamed to the caller page by page,
+            # instead of collecting the whole time range in memory.
+            events_in_page.sort(key=BY_CREATED_TIME)
+            yield events_in_page
+    finally:
+        # If the consumer stops early, unblock the reader so that it does not outlive the collector.
+        stop.set()
+        while reader.is_alive():
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+def retry(func: Callable, ex_type: type[BaseException] | tuple[type[BaseException], ...] = Exception,
+          limit: int = 0, wait_ms: int = 100, wait_increase_ratio: float = 2, max_wait_ms: int = 60_000,
+          logger: Optional[logging.Logger] = None, retry_if: Optional[Callable[[BaseException], bool]] = None):
+    # The function is called lazily, so that every attempt reruns it.
+    attempt: int = 1
+    while True:
+        try:
+            return func()
+        except ex_type as e:
+            # retry_if narrows down the exceptions that cannot be told apart by their type.
+            if attempt >= limit or (retry_if is not None and not retry_if(e)):
+                raise
+            # The jitter spreads the reconnections of multiple collectors on the same vCenter.
+            jittered_wait_ms: float = random.uniform(0.8, 1.2) * wait_ms
+            if logger is not None:
+                logger.warning(
+                    "Attempt %d of %d failed: %s. Retrying in %.0f ms...", attempt, limit, e, jittered_wait_ms)
+            time.sleep(jittered_wait_ms / 1000)
+            # The wait is capped, so that the backoff does not turn into a hang.
+            wait_ms = min(int(wait_ms * wait_increase_ratio), max_wait_ms)
+            attempt += 1
+
+
+def is_connection_error(e: BaseException) -> bool:
+    return isinstance(e, CONNECTION_ERRORS) or (isinstance(e, OSError) and e.errno in UNREACHABLE_ERRNOS)
+
+
+def merge_pages(pages: Iterable[list[vim.event.Event]], page_size: int) -> Iterator[list[vim.event.Event]]:
+    # The pages are already sorted, so a k-way merge is enough for a globally sorted output.
+    # All the pages are kept in memory until they are merged.
+    merged: Iterable[vim.event.Event] = heapq.merge(
+        *list(pages), key=BY_CREATED_TIME)
+    while True:
+        events: list[vim.event.Event] = list(
+            itertools.islice(merged, page_size))
+        if len(events) == 0:
             break
-        # or do other things on the collected events
-        events.extend(events_in_page)
+        yield events
 
-    # Please note that the events collected are not ordered by the event creation time
-    # You might find the first event in the third page for example.
-    return sorted(events, key=lambda x: x.createdTime)
 
+def skip_seen(pages: Iterable[list[vim.event.Event]], seen: set[int],
+              keys: set[int]) -> Iterator[list[vim.event.Event]]:
+    # The event keys are unique, the ones already in seen or keys are dropped, the rest are added to keys.
+    for events in pages:
+        fresh: list[vim.event.Event] = []
+        for event in events:
+            if event.key in seen or event.key in keys:
+                continue
+            keys.add(event.key)
+            fresh.append(event)
+        if len(fresh) > 0:
+            yield fresh
 
-def get_collector(host: str, port: int, user: str, password: str, filter_spec: vim.event.EventFilterSpec) -> vim.event.EventHistoryCollector:
 
+def connect(host: str, port: int, user: str, password: str) -> vim.ServiceInstance:
     si: vim.ServiceInstance = SmartConnect(
         host=host,
         port=port,
@@ -59,6 +276,46 @@ def get_collector(host: str, port: int, user: str, password: str, filter_spec: v
         pwd=password,
         disableSslCertValidation=True,
         connectionPoolTimeout=30)  # 30 seconds for timeout
+
+    return si
+
+
+def resume_session(host: str, port: int) -> Optional[vim.ServiceInstance]:
+    # The saved session cookie is reused, so that a short run does not need to log in again.
+    # The first line is the server the cookie belongs to, so that it is never sent to another one.
+    try:
+        with open(SESSION_PATH, mode="r", encoding=ENCODING) as session:
+            target: str = session.readline().strip()
+            cookie: str = session.read().strip()
+    except OSError:
+        return None
+    if target != f"{host}:{port}" or not cookie:
+        return None
+
+    stub = SmartStubAdapter(
+        host=host,
+        port=port,
+        disableSslCertValidation=True,
+        connectionPoolTimeout=30)  # 30 seconds for timeout
+    stub.cookie = cookie
+    si: vim.ServiceInstance = vim.ServiceInstance("ServiceInstance", stub)
+    # The session may have expired or logged out on the server since it was saved.
+    if si.content.sessionManager.currentSession is None:
+        return None
+
+    return si
+
+
+def save_session(si: vim.ServiceInstance, host: str, port: int) -> None:
+    # The cookie grants access to vCenter, so it is readable by the owner only.
+    os.makedirs(os.path.dirname(SESSION_PATH), mode=0o700, exist_ok=True)
+    fd: int = os.open(SESSION_PATH, os.O_WRONLY |
+                      os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, mode="w", encoding=ENCODING) as session:
+        session.write(f"{host}:{port}\n{si._stub.cookie}")
+
+
+def get_collector(si: vim.ServiceInstance, filter_spec: vim.event.EventFilterSpec) -> vim.event.EventHistoryCollector:
     eventManager: vim.event.EventManager = si.content.eventManager
     event_collector: vim.event.EventHistoryCollector = eventManager.CreateCollector(
         filter=filter_spec)
@@ -66,63 +323,315 @@ def get_collector(host: str, port: int, user: str, password: str, filter_spec: v
     return event_collector
 
 
-def get_filters(from_now: timedelta, event_types: Optional[list[EventType]] = None) -> tuple[vim.event.EventFilterSpec.ByTime, vim.event.EventFilterSpec]:
+def set_page_size(event_collector: vim.event.EventHistoryCollector, page_size: int) -> int:
+    # Larger pages mean fewer ReadNext round-trips, but older vCenter versions reject more than the default.
+    # It also sets the size of the latest page, which is 10 by default.
+    try:
+        event_collector.SetCollectorPageSize(maxCount=page_size)
+    except vmodl.fault.InvalidArgument:
+        logging.warning(
+            "Page size %d is not accepted by the server. Falling back to %d.", page_size, DEFAULT_PAGE_SIZE)
+        return DEFAULT_PAGE_SIZE
+    return page_size
+
+
+def keep_alive(si: vim.ServiceInstance, seconds: float) -> None:
+    # Wait for the next run while keeping the session from timing out.
+    deadline: float = time.monotonic() + seconds
+    while True:
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, KEEPALIVE_SECONDS))
+        si.CurrentTime()
+
+
+def resolve_host(host: str, port: int) -> tuple[str, str]:
+    # A single lookup returns both the canonical name and the address, either IPv4 or IPv6.
+    infos = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_CANONNAME)
+    _, _, _, canonical_name, sockaddr = infos[0]
+    return canonical_name or host, sockaddr[0]
+
+
+def get_filters(from_now: timedelta, event_type_ids: Optional[tuple[str, ...]] = None, until_now: bool = True,
+                categories: Optional[list[str]] = None, entity: Optional[vim.ManagedEntity] = None
+                ) -> tuple[vim.event.EventFilterSpec.ByTime, vim.event.EventFilterSpec]:
     time_filter = vim.event.EventFilterSpec.ByTime()
-    now: datetime = datetime.now()
+    # The time is timezone-aware, so that vCenter does not interpret it in its own timezone.
+    now: datetime = datetime.now(timezone.utc)
     time_filter.beginTime = now - from_now
-    time_filter.endTime = now
-    if event_types:
-        filter_spec = vim.event.EventFilterSpec(
-            eventTypeId=[e.name for e in event_types], time=time_filter)
-    else:
-        filter_spec = vim.event.EventFilterSpec(time=time_filter)
+    # Without an end time, the collector keeps receiving the new events.
+    if until_now:
+        time_filter.endTime = now
+    filter_spec = vim.event.EventFilterSpec(time=time_filter)
+    # The more selective the filter is, the less events are returned by vCenter.
+    if event_type_ids:
+        filter_spec.eventTypeId = list(event_type_ids)
+    if categories:
+        filter_spec.category = categories
+    if entity is not None:
+        filter_spec.entity = vim.event.EventFilterSpec.ByEntity(
+            entity=entity, recursion=vim.event.EventFilterSpec.RecursionOption.all)
 
     return time_filter, filter_spec
 
 
-def add_entity_to_root(root, entity_name, entity) -> None:
-    if entity is not None:
-        try:
-            if (hasattr(entity, "name")):
-                root["vmware"][entity_name] = {
-                    "name": entity.name
-                }
-            else:
-                root["vmware"][entity_name] = entity
-        except Exception as e:
-            print(f"Error adding {entity_name} to root: {e}")
+def find_entity(si: vim.ServiceInstance, inventory_path: str) -> vim.ManagedEntity:
+    entity: Optional[vim.ManagedEntity] = si.content.searchIndex.FindByInventoryPath(
+        inventoryPath=inventory_path)
+    if entity is None:
+        raise Exception(f"Could not find the entity: {inventory_path}")
+
+    return entity
+
+
+def to_json(root: dict) -> bytes:
+    if USE_ORJSON:
+        # Datetime values are passed to the default handler to keep the same output as the json module.
+        return orjson.dumps(root, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return JSON_ENCODER.encode(root).encode(ENCODING)
+
+
+def get_property_getter(event_type: type) -> tuple[tuple[str, ...], Callable]:
+    # pyVmomi data objects share the same property list per type,
+    # so the property names and the getter are resolved once per event type.
+    property_getter = PROPERTY_GETTERS.get(event_type)
+    if property_getter is None:
+        # Every event type inherits the properties of vim.event.Event, so the getter always returns a tuple.
+        names: tuple[str, ...] = tuple(
+            p.name for p in event_type._GetPropertyList())  # type: ignore[attr-defined]
+        property_getter = (names, attrgetter(*names))
+        PROPERTY_GETTERS[event_type] = property_getter
+
+    return property_getter
+
+
+def get_properties(event) -> dict:
+    names, getter = get_property_getter(type(event))
+    return {k: v for k, v in zip(names, getter(event)) if (
+        v is not None and v != '<unset>')}
 
 
 def to_event_log(event) -> dict[str, dict]:
-    root = {
-        "vmware": {
-            "timestamp": event.createdTime.isoformat(),
-            "event": event.fullFormattedMessage,
-            "username": event.userName,
-            "properties": {k: v for k, v in event.__dict__.items() if (
-                v is not None and v != '<unset>')}
-        }
+    vmware: dict = {
+        "timestamp": event.createdTime.isoformat(),
+        "event": event.fullFormattedMessage,
+        "username": event.userName,
+        "properties": get_properties(event)
     }
 
-    add_entity_to_root(root, "host", event.host)
-    add_entity_to_root(root, "vm", event.vm)
-    add_entity_to_root(root, "ds", event.ds)
-    add_entity_to_root(root, "dvs", event.dvs)
-    add_entity_to_root(root, "net", event.net)
-    add_entity_to_root(root, "computeResource",
-                       event.computeResource)
-    add_entity_to_root(root, "datacenter", event.datacenter)
-    add_entity_to_root(root, "info", getattr(event, "info", None))
-    add_entity_to_root(root, "ipAddress",
-                       getattr(event, "ipAddress", None))
+    for entity_name in ENTITY_ARGUMENTS:
+        entity = getattr(event, entity_name, None)
+        if entity is None:
+            continue
+        # The entity arguments are added by name, the rest as is.
+        name = getattr(entity, "name", MISSING)
+        vmware[entity_name] = entity if name is MISSING else {"name": name}
+
+    return {"vmware": vmware}
+
+
+def rotate(vcenter_logs: BinaryIO, max_size: int) -> BinaryIO:
+    # Large append-only files slow down the writes, so the file is moved aside once it exceeds the limit.
+    # Only the last rotated file is kept.
+    if os.fstat(vcenter_logs.fileno()).st_size < max_size:
+        return vcenter_logs
+
+    output: str = vcenter_logs.name  # type: ignore
+    vcenter_logs.close()
+    os.replace(output, output + ".1")
+    logging.info("Rotated %s to %s.1", output, output)
+
+    return open(output, mode="ab", buffering=0)
+
+
+def write_all(fd: int, data: bytearray) -> None:
+    # os.write may write less than requested, so it is repeated until everything is written.
+    view = memoryview(data)
+    while len(view) > 0:
+        written: int = os.write(fd, view)
+        view = view[written:]
+
+
+def write_events(vcenter_logs: BinaryIO, pages: Iterable[list[vim.event.Event]]) -> int:
+    count: int = 0
+    fd: int = vcenter_logs.fileno()
+    # The serialized events are collected in a local buffer and written to the file descriptor in large chunks,
+    # bypassing the locking of the buffered writer.
+    buffer = bytearray()
+    # The method lookups are hoisted out of the loops, the buffer is the same for all pages.
+    # The messages are formatted lazily, only if the level is enabled.
+    add_line = buffer.extend
+    log_error = logging.error
+    for events in pages:
+        count += len(events)
+        for event in events:
+            try:
+                root = to_event_log(event)
+
+                add_line(to_json(root))
+                add_line(b"\n")
+            except AttributeError as e:
+                log_error("Error processing event %s: %s", event, e)
+        if len(buffer) >= WRITE_BUFFER_SIZE:
+            write_all(fd, buffer)
+            buffer.clear()
+    # The file is kept open across the runs, so the rest is written before returning.
+    write_all(fd, buffer)
 
-    return root
+    return count
 
 
-def main() -> None:
+def collect_once(si: vim.ServiceInstance, vcenter_logs: BinaryIO, interval: int, start_time: float,
+                 event_type_ids: Optional[tuple[str, ...]], page_size: int, categories: Optional[list[str]] = None,
+                 entity: Optional[vim.ManagedEntity] = None, sort: bool = False, seen: Optional[set[int]] = None,
+                 keys: Optional[set[int]] = None) -> None:
+    # In order to tolerate the query time drift between two runs,
+    # we calculate the time between the start of the run and filtering time
+    # Also, we add 2 extra seconds as a buffer.
+    # The event types are always forwarded, so that the filtering is done by vCenter.
+    # When there are no event types defined, get_filters falls back to the unfiltered mode.
+    time_filter, filter_spec = get_filters(
+        from_now=timedelta(seconds=interval + (time.monotonic() - start_time) + 2), event_type_ids=event_type_ids,
+        categories=categories, entity=entity)
+
+    event_collector: vim.event.EventHistoryCollector = get_collector(
+        si, filter_spec)
+
+    logging.info("Generated collector.")
+
+    try:
+        page_size = set_page_size(event_collector, page_size)
+
+        logging.info("Querying events...")
+        # The pages are closed before the collector is destroyed, so that the reader stops first, even on errors.
+        with contextlib.closing(iter_events(event_collector=event_collector, page_size=page_size)) as read:
+            pages: Iterator[list[vim.event.Event]] = read
+            if sort:
+                pages = merge_pages(pages, page_size)
+
+            # The time ranges of the consecutive runs overlap, so the events written by the previous run are skipped.
+            # The keys are owned by the caller, so that the events written by a failed run are skipped by its retry.
+            pages = skip_seen(pages, seen if seen is not None else set(), keys if keys is not None else set())
+
+            logging.info("Writing events to target: %s...", vcenter_logs.name)
+            count: int = write_events(vcenter_logs, pages)
+    finally:
+        # The collectors are limited per session, so they are not left behind on the server.
+        event_collector.DestroyCollector()
+
+    logging.info("Fetched totally %d events in the given time range from %s to %s.",
+                 count, time_filter.beginTime, time_filter.endTime)
+
+    logging.info("Log collection completed!")
+
+
+def get_latest_page_filter(si: vim.ServiceInstance,
+                           event_collector: vim.event.EventHistoryCollector) -> vmodl.query.PropertyCollector.Filter:
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(
+            obj=event_collector)],
+        propSet=[vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.event.EventHistoryCollector, pathSet=["latestPage"])])
+
+    return si.content.propertyCollector.CreateFilter(filter_spec, partialUpdates=False)
+
 
-    start_time = datetime.now()
+def watch_events(si: vim.ServiceInstance, interval: int, start_time: float, event_type_ids: Optional[tuple[str, ...]],
+                 page_size: int, categories: Optional[list[str]] = None, entity: Optional[vim.ManagedEntity] = None,
+                 sort: bool = False, last_key: int = 0) -> Iterator[list[vim.event.Event]]:
+    # The history is read once, then vCenter pushes the new events via the latest page of the same collector.
+    # The events are yielded to the caller, so that it can rotate the output
+    # and resume from the last key after a reconnect.
+    time_filter, filter_spec = get_filters(
+        from_now=timedelta(seconds=interval + (time.monotonic() - start_time) + 2), event_type_ids=event_type_ids,
+        until_now=False, categories=categories, entity=entity)
 
+    event_collector: vim.event.EventHistoryCollector = get_collector(
+        si, filter_spec)
+
+    logging.info("Generated collector.")
+
+    property_filter: Optional[vmodl.query.PropertyCollector.Filter] = None
+    try:
+        page_size = set_page_size(event_collector, page_size)
+
+        # The event keys are incremental, so the events up to the last key are already written.
+        # The history is not ordered by key, so it is compared with the last key of the previous watch.
+        written_key: int = last_key
+
+        logging.info("Querying events...")
+        # The pages are closed before the collector is destroyed, so that the reader stops first, even on errors.
+        with contextlib.closing(iter_events(event_collector=event_collector, page_size=page_size)) as read:
+            history: Iterator[list[vim.event.Event]] = read
+            if sort:
+                history = merge_pages(history, page_size)
+            count: int = 0
+            for events in history:
+                events = [e for e in events if e.key > written_key]
+                if len(events) == 0:
+                    continue
+                last_key = max(last_key, max(e.key for e in events))
+                count += len(events)
+                yield events
+
+        logging.info("Fetched totally %d events in the given time range from %s.",
+                     count, time_filter.beginTime)
+
+        logging.info("Waiting for new events...")
+        property_filter = get_latest_page_filter(si, event_collector)
+        # Waiting also keeps the session alive.
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=WAIT_SECONDS)
+        version: str = ""
+        while True:
+            update = si.content.propertyCollector.WaitForUpdatesEx(
+                version, options)
+            if update is None:
+                continue
+            version = update.version
+
+            for filter_set in update.filterSet:
+                for object_set in filter_set.objectSet:
+                    for change in object_set.changeSet:
+                        if change.name != "latestPage" or not change.val:
+                            continue
+                        latest_page: list[vim.event.Event] = cast(list[vim.event.Event], change.val)
+                        new_events: list[vim.event.Event] = [
+                            e for e in latest_page if e.key > last_key]
+                        if len(new_events) == 0:
+                            continue
+                        new_events.sort(key=BY_CREATED_TIME)
+                        last_key = max(e.key for e in new_events)
+                        logging.info("Fetched %d new events.", len(new_events))
+                        yield new_events
+    finally:
+        if property_filter is not None:
+            property_filter.Destroy()
+        event_collector.DestroyCollector()
+
+
+def parse_duration(value: str) -> timedelta:
+    # Accepts durations like 30s, 5m, 1h or 1d.
+    match: Optional[re.Match] = re.fullmatch(r"(\d+)([smhd])", value.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            f"Invalid duration: {value}. Use a number followed by s, m, h or d, e.g. 15m")
+
+    return timedelta(seconds=int(match.group(1)) * DURATION_UNITS[match.group(2)])
+
+
+def parse_positive_int(value: str) -> int:
+    # Accepts whole numbers greater than zero, e.g. a page size.
+    if re.fullmatch(r"\d+", value.strip()) is None or int(value) <= 0:
+        raise argparse.ArgumentTypeError(
+            f"Invalid number: {value}. Use a whole number greater than zero, e.g. 1000")
+
+    return int(value)
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(
         description=f"""
             {APP_NAME} ({APP_VERSION}) is a tool to pull VMware vCenter logs based on time and type filters. It is better than collecting syslog with all of the noise.
@@ -136,6 +645,7 @@ def main() -> None:
     parser.add_argument("-p", "--port",
                         dest="port",
                         required=False,
+                        type=int,
                         default=443,
                         help="VMware vCenter host port to connect (Default: 443)")
 
@@ -150,23 +660,104 @@ def main() -> None:
                         default="conf.py",
                         help="Path to configuration file (Default: conf.py)")
 
-    args = parser.parse_args()
+    parser.add_argument("-i", "--interval", "--since",
+                        dest="interval",
+                        required=False,
+                        type=parse_duration,
+                        help="The time range to collect and the interval between the runs, "
+                        "e.g. 30s, 5m, 1h, 1d (Default: 15m)")
+
+    parser.add_argument("--page-size",
+                        dest="page_size",
+                        required=False,
+                        type=parse_positive_int,
+                        help=f"The number of events read per request (Default: {DEFAULT_PAGE_SIZE})")
+
+    parser.add_argument("-d", "--daemon",
+                        dest="daemon",
+                        required=False,
+                        action="store_true",
+                        help="Keep running and collect the logs in every interval reusing the same session")
+
+    parser.add_argument("-w", "--watch",
+                        dest="watch",
+                        required=False,
+                        action="store_true",
+                        help="Keep running and wait for the new events pushed by vCenter instead of polling")
+
+    parser.add_argument("-s", "--sort",
+                        dest="sort",
+                        required=False,
+                        action="store_true",
+                        help="Sort all events in the time range by creation time, keeping them in memory")
+
+    parser.add_argument("-k", "--keep-session",
+                        dest="keep_session",
+                        required=False,
+                        action="store_true",
+                        help="Keep the session after exit and resume it in the next run "
+                        f"(Saved to ~/.{APP_NAME}/session)")
+
+    return parser
+
+
+PARSER: Final[argparse.ArgumentParser] = build_parser()
+
+
+def main() -> None:
+
+    # Monotonic clock is used for the elapsed time, the wall clock is only needed for the filters.
+    start_time: float = time.monotonic()
+
+    args = PARSER.parse_args()
+
+    if (USE_CONF):
+        interval: int = INTERVAL_MINUTES * 60
+        event_type_ids: Optional[tuple[str, ...]] = EVENT_TYPE_IDS
+        categories: Optional[list[str]] = getattr(conf, "EVENT_CATEGORIES", None)
+        entity_path: Optional[str] = getattr(conf, "ENTITY_PATH", None)
+        # The settings added after the first release are optional, so that the older configuration files still work.
+        page_size: int = getattr(conf, "PAGE_SIZE", DEFAULT_PAGE_SIZE)
+        max_log_size: int = getattr(conf, "MAX_LOG_SIZE_MB", 0) << 20
+    else:
+        interval = 15 * 60
+        event_type_ids = None
+        categories = None
+        entity_path = None
+        page_size = DEFAULT_PAGE_SIZE
+        max_log_size = 0
+
+    # The command line overrides the configuration file, when given.
+    if (args.interval is not None):
+        interval = int(args.interval.total_seconds())
+    if (args.page_size is not None):
+        page_size = args.page_size
+
+    # An empty time range cannot have any events, so neither a session nor a collector is needed.
+    # It is checked before anything else, even the target host, since none of them would be used.
+    # In watch mode, it still waits for the new events.
+    if (interval <= 0 and args.watch is False):
+        logging.info("The time range is empty. Nothing to collect.")
+        return
+
+    load_vmomi()
 
     if (USE_CONF):
         host: str = HOST
     else:
         host = str(args.vCenter)  # type: ignore
 
-    try:
-        fqdn = socket.getfqdn(host)
-        ip = socket.gethostbyname(fqdn)
-    except:
-        raise Exception(f"Could not resolve target host name: {host}")
-
     if (USE_CONF):
         port: int = PORT
     else:
-        port = int(args.port)  # type: ignore
+        port = args.port
+
+    try:
+        fqdn, ip = resolve_host(host, port)
+    # Only the resolution errors are caught, so that KeyboardInterrupt and SystemExit are not masked.
+    # Invalid host names, like too long labels, fail in the IDNA codec with UnicodeError.
+    except (OSError, UnicodeError) as e:
+        raise RuntimeError(f"Could not resolve target host name: {host}") from e
 
     if (USE_CONF):
         output: str = LOG_PATH
@@ -174,10 +765,14 @@ def main() -> None:
         output = str(args.output)  # type: ignore
 
     output = os.path.abspath(output)
-    output_dir: str = os.path.dirname(output)
-    if ((os.path.exists(output_dir) is False) and (os.access(output_dir, os.W_OK) is False)):
-        raise Exception(f"Path does not exist or is not accessible.")
-    logging.info(f"Output: {output}")
+    # Opening the file validates the path and the permissions at once.
+    # The same file is used for the whole lifetime of the application.
+    try:
+        vcenter_logs: BinaryIO = open(output, mode="ab", buffering=0)
+    except OSError as e:
+        raise Exception(f"Cannot open {output}: {e}")
+    atexit.register(lambda: vcenter_logs.close())
+    logging.info("Output: %s", output)
 
     if (USE_CONF):
         user: str = USERNAME
@@ -186,57 +781,87 @@ def main() -> None:
         user = input('VMware username:\n')
         password = getpass.getpass()
 
-    print(f"Connecting to {fqdn}:{port} ({ip}) as {user}...")
-    logging.info(f"Connecting to {fqdn}:{port} ({ip}) as {user}...")
-
-    if (USE_CONF):
-        interval: int = INTERVAL_MINUTES * 60
-    else:
-        interval = 15 * 60
-
-    # In order to tolerate the query time drift between two runs,
-    # we calculate the time between the start of application and filtering time
-    # Also, we add 2 extra seconds as a buffer.
-    if (EVENT_TYPES):
-        time_filter, filter_spec = get_filters(
-            from_now=timedelta(seconds=interval + (datetime.now() - start_time).seconds + 2), event_types=EVENT_TYPES)
+    logging.info("Connecting to %s:%d (%s) as %s...", fqdn, port, ip, user)
+
+    def with_retry(func: Callable):
+        # Only the connection errors are retried, the invalid credentials are not.
+        # The same errors are retried here and recovered by reconnecting in the loop below.
+        return retry(func=func, ex_type=(OSError, http.client.HTTPException), retry_if=is_connection_error,
+                     limit=5, wait_ms=10000, wait_increase_ratio=2, max_wait_ms=60_000, logger=logging.getLogger())
+
+    def login() -> vim.ServiceInstance:
+        si: vim.ServiceInstance = with_retry(
+            lambda: connect(host, port, user, password))
+        if (args.keep_session):
+            save_session(si, host, port)
+        return si
+
+    # The session is reused across the runs in daemon mode.
+    # With keep session, it is also saved to be resumed by the next run.
+    resumed: Optional[vim.ServiceInstance] = with_retry(
+        lambda: resume_session(host, port)) if args.keep_session else None
+    if (resumed is None):
+        si: vim.ServiceInstance = login()
     else:
-        time_filter, filter_spec = get_filters(
-            from_now=timedelta(seconds=interval + (datetime.now() - start_time).seconds + 2))
-
-    event_collector: vim.event.EventHistoryCollector = get_collector(
-        host, port, user, password, filter_spec)
-
-    print("Connected.")
+        si = resumed
+        logging.info("Resumed the saved session.")
     logging.info("Connected.")
-    print("Generated collector.")
-    logging.info("Generated collector.")
 
-    print("Querying events...")
-    logging.info("Querying events...")
-    events: list[vim.event.Event] = get_events(
-        event_collector=event_collector)
-
-    msg: str = "Fetched totally {} events in the given time range from {} to {}.".format(
-        len(events), time_filter.beginTime, time_filter.endTime
-    )
-    print(msg)
-    logging.info(msg)
-
-    print(f"Writing events to target: {output}...")
-    logging.info(f"Writing events to target: {output}...")
-    with open(output, mode="a+", encoding=ENCODING) as vcenter_logs:
-        for _, event in enumerate(events):
-            try:
-                root = to_event_log(event)
-
-                vcenter_logs.write(json.dumps(
-                    root, sort_keys=True, default=str) + "\n")
-            except AttributeError as e:
-                logging.error(f"Error processing event {event}: {e}")
+    try:
+        entity: Optional[vim.ManagedEntity] = None
+        if (entity_path):
+            entity = find_entity(si, entity_path)
+
+        # The keys of the events written by the previous run and by the current one
+        seen: set[int] = set()
+        keys: set[int] = set()
+        # The key of the last event written in watch mode
+        last_key: int = 0
+        while True:
+            if (max_log_size > 0):
+                vcenter_logs = rotate(vcenter_logs, max_log_size)
 
-    print("Log collection completed!")
-    logging.info("Log collection completed!")
+            try:
+                if (args.watch):
+                    # It returns only when the session is lost.
+                    for events in watch_events(si, interval, start_time, event_type_ids, page_size,
+                                               categories, entity, args.sort, last_key):
+                        write_events(vcenter_logs, [events])
+                        last_key = max(last_key, max(e.key for e in events))
+                        # After a reconnect, only the time since the last write is read again.
+                        start_time = time.monotonic()
+                        if (max_log_size > 0):
+                            vcenter_logs = rotate(vcenter_logs, max_log_size)
+                else:
+                    collect_once(si, vcenter_logs, interval, start_time,
+                                 event_type_ids, page_size, categories, entity, args.sort, seen, keys)
+                    seen, keys = keys, set()
+
+                if (args.daemon is False):
+                    break
+
+                keep_alive(si, interval - (time.monotonic() - start_time))
+                start_time = time.monotonic()
+                continue
+            except vim.fault.NotAuthenticated:
+                logging.warning("Session expired. Reconnecting...")
+            except (OSError, http.client.HTTPException) as e:
+                if not is_connection_error(e):
+                    raise
+                logging.warning("Connection lost: %s. Reconnecting...", e)
+
+            # The next run covers the time since the failed one started.
+            si = login()
+            # The managed objects are bound to the session, so the entity is looked up again.
+            if (entity_path):
+                entity = find_entity(si, entity_path)
+    finally:
+        # The session is logged out here instead of an atexit handler, which is skipped by os._exit.
+        if (args.keep_session is False):
+            try:
+                Disconnect(si)
+            except (vmodl.MethodFault, OSError, http.client.HTTPException) as e:
+                logging.warning("Could not log out: %s", e)
 
 
 if __name__ == "__main__":
@@ -246,6 +871,10 @@ if __name__ == "__main__":
                             format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
                             datefmt="%Y-%m-%dT%H:%M:%S%z",
                             level=logging.INFO)
+        # The status messages are printed to the console via the same logger.
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        logging.getLogger().addHandler(console)
 
         excepthook = logging.error
         logging.info('Starting')